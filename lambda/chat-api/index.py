@@ -14,7 +14,16 @@ import boto3
 AGENT_ID = os.environ["AGENT_ID"]
 AGENT_ALIAS_ID = os.environ["AGENT_ALIAS_ID"]
 
-bedrock_agent = boto3.client("bedrock-agent-runtime")
+# ── globals reused across warm invocations ───────────────────────────────
+_bedrock_agent = None
+
+
+def _agent():
+    """Return the Bedrock Agent runtime client, created on first use."""
+    global _bedrock_agent
+    if _bedrock_agent is None:
+        _bedrock_agent = boto3.client("bedrock-agent-runtime")
+    return _bedrock_agent
 
 
 def handler(event, context):
@@ -39,19 +48,20 @@ def handler(event, context):
     session_id = body.get("session_id") or str(uuid.uuid4())
 
     try:
-        response = bedrock_agent.invoke_agent(
+        response = _agent().invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
             sessionId=session_id,
             inputText=message,
         )
 
-        # Collect the streamed response
-        completion = ""
+        # Collect the streamed response; decode once at the end so a
+        # multi-byte character split across chunks stays intact
+        buf = bytearray()
         for event_chunk in response.get("completion", []):
             if "chunk" in event_chunk:
-                chunk_bytes = event_chunk["chunk"].get("bytes", b"")
-                completion += chunk_bytes.decode("utf-8")
+                buf.extend(event_chunk["chunk"].get("bytes", b""))
+        completion = buf.decode("utf-8")
 
         return {
             "statusCode": 200,
@@ -82,3 +92,14 @@ def error_response(status_code, message):
         "headers": cors_headers(),
         "body": json.dumps({"error": message}),
     }
+
+
+# ── cold-start warm-up ───────────────────────────────────────────────────
+# Build the Bedrock client (service model load, endpoint rules, credential
+# chain) during INIT, which runs with boosted CPU, rather than on the first
+# request. Failures are left for the first request to surface.
+
+try:
+    _agent()
+except Exception as exc:
+    print(f"Warm-up failed: {exc}")
@@ -2,117 +2,343 @@
 Query Lambda: Bedrock Agent action-group handler.
 
 Provides five tools the agent can invoke:
-  - query_data        Run arbitrary SQL against the DuckDB index
+  - query_data        Run arbitrary SQL against the indexed tables
   - list_tables       Show every indexed table + row count
   - describe_table    Column types and a 5-row sample
   - list_repo_files   List files in the synced repo
   - read_repo_file    Return the text of a single repo file
 """
 
-import json
+import codecs
+import gzip
 import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
 
 import boto3
 import duckdb
+import orjson
+from botocore.exceptions import ClientError
 
 S3_BUCKET = os.environ["S3_BUCKET"]
-DB_LOCAL = "/tmp/data.duckdb"
-MANIFEST_LOCAL = "/tmp/manifest.json"
-
-s3 = boto3.client("s3")
+DUCKDB_EXTENSION_DIR = os.environ.get(
+    "DUCKDB_EXTENSION_DIR", "/tmp/duckdb_extensions"
+)
+# DuckDB threads block on their range GETs when scanning Parquet over S3, so
+# run more of them than the Lambda has vCPUs to keep parallel requests in
+# flight; S3 throughput scales with concurrent streams.
+DUCKDB_THREADS = int(os.environ.get("DUCKDB_THREADS", "16"))
+
+# read_repo_file shows at most 20 000 chars; a UTF-8 char is at most 4 bytes
+MAX_FILE_CHARS = 20_000
+MAX_FILE_BYTES = 4 * MAX_FILE_CHARS
+
+MANIFEST_KEY = "index/manifest.json.gz"
+# Written by syncs that predate the Parquet index; read until the next sync
+LEGACY_MANIFEST_KEY = "index/manifest.json"
+LEGACY_DB_URI = f"s3://{S3_BUCKET}/index/data.duckdb"
+# Local database holding only the table view definitions
+VIEWS_DB_LOCAL = "/tmp/index_views.duckdb"
+# How often a warm container checks whether a sync has replaced the index
+SYNC_CHECK_SECONDS = 60
+
+# Single SELECT/WITH/FROM statements are counted inside DuckDB, and memoized
+# when they use nothing volatile; anything else may change state or answer
+# differently.
+_SELECT_RE = re.compile(r"\s*(select|with|from)\b", re.IGNORECASE)
+_UNCACHEABLE_RE = re.compile(
+    r"\b(random|setseed|uuid|gen_random_uuid|nextval|currval|now|today"
+    r"|current_date|current_time|current_timestamp|get_current_time"
+    r"|get_current_timestamp|localtime|localtimestamp|sample|tablesample"
+    r"|insert|update|delete|create|drop|alter|copy|attach|detach|set"
+    r"|pragma|call|install|load)\b",
+    re.IGNORECASE,
+)
 
 # ── globals reused across warm invocations ───────────────────────────────
+_s3_client = None
 _con = None
+_con_state = None
 _manifest = None
+_manifest_etag = None
+_sync_checked_at = 0.0
+
+
+def _s3():
+    """Return the S3 client, created on first use."""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client("s3")
+    return _s3_client
+
+
+def _sql_str(value):
+    """Quote a value as a SQL string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _setup(con, attach_legacy):
+    """Load httpfs and register the Lambda role's credentials on ``con``.
+
+    Credentials come from boto3's default chain; ``attach_legacy`` also
+    attaches the pre-Parquet data.duckdb that legacy views read from.
+    """
+    session = boto3.Session()
+    creds = session.get_credentials().get_frozen_credentials()
+
+    con.execute("INSTALL httpfs")
+    con.execute("LOAD httpfs")
+    secret = [
+        "TYPE S3",
+        f"KEY_ID {_sql_str(creds.access_key)}",
+        f"SECRET {_sql_str(creds.secret_key)}",
+        f"REGION {_sql_str(session.region_name or 'us-east-1')}",
+    ]
+    if creds.token:
+        secret.append(f"SESSION_TOKEN {_sql_str(creds.token)}")
+    con.execute(f"CREATE SECRET ({', '.join(secret)})")
+    if attach_legacy:
+        # Manifest from an older sync: its tables live in the monolithic
+        # data.duckdb, which DuckDB can also range-read over httpfs
+        con.execute(f"ATTACH {_sql_str(LEGACY_DB_URI)} AS legacy (READ_ONLY)")
+
+
+def _connect():
+    """Open DuckDB read-only over a view for each indexed table in S3.
+
+    DuckDB reads the Parquet files over httpfs with byte-range GETs, so
+    only the column chunks a query touches are fetched. The views are
+    written to a local database file that is then reopened read-only with
+    its configuration locked, so agent SQL cannot drop or redefine them
+    for later requests.
+    """
+    tables = _get_manifest().get("tables", [])
+    attach_legacy = any("parquet" not in t for t in tables)
+    config = {
+        "extension_directory": DUCKDB_EXTENSION_DIR,
+        "threads": DUCKDB_THREADS,
+        "allow_persistent_secrets": False,
+    }
+
+    for stale in (VIEWS_DB_LOCAL, VIEWS_DB_LOCAL + ".wal"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    with duckdb.connect(VIEWS_DB_LOCAL, config=config) as con:
+        # Creating a view binds it, which reads the Parquet footers
+        _setup(con, attach_legacy)
+        for table in tables:
+            if "parquet" in table:
+                uri = f"s3://{S3_BUCKET}/{table['parquet']}"
+                source = f"read_parquet({_sql_str(uri)})"
+            else:
+                source = f'legacy."{table["name"]}"'
+            con.execute(f'CREATE VIEW "{table["name"]}" AS SELECT * FROM {source}')
+
+    con = duckdb.connect(VIEWS_DB_LOCAL, read_only=True, config=config)
+    _setup(con, attach_legacy)
+    con.execute("SET lock_configuration = true")
+    return con
+
+
+def _db_state(con):
+    """Snapshot the shared state that tool SQL could still change.
+
+    Secrets and attached databases belong to the whole DuckDB instance and
+    are not covered by read-only mode or the configuration lock.
+    """
+    return (
+        con.execute("SELECT database_name FROM duckdb_databases() ORDER BY ALL").fetchall(),
+        con.execute("SELECT * FROM duckdb_secrets() ORDER BY name").fetchall(),
+        con.execute(
+            "SELECT database_name, view_name, sql FROM duckdb_views() "
+            "WHERE NOT internal ORDER BY ALL"
+        ).fetchall(),
+    )
+
+
+def _close_db():
+    """Close and forget the shared connection."""
+    global _con
+    if _con is not None:
+        try:
+            _con.close()
+        except Exception:
+            pass
+        _con = None
 
 
 def _get_db():
-    """Return a DuckDB connection, downloading from S3 on cold start."""
-    global _con
+    """Return the shared DuckDB connection, opened on cold start.
+
+    Reopened whenever its state no longer matches the snapshot taken at
+    open time. Tools run their SQL on a ``cursor()`` of it, so temporary
+    objects, ``USE`` and session settings die with the cursor.
+    """
+    global _con, _con_state
     if _con is not None:
         try:
-            _con.execute("SELECT 1")
-            return _con
+            if _db_state(_con) == _con_state:
+                return _con
+            print("DuckDB state changed since open; reconnecting")
         except Exception:
-            _con = None
+            pass
+        _close_db()
 
-    s3.download_file(S3_BUCKET, "index/data.duckdb", DB_LOCAL)
-    _con = duckdb.connect(DB_LOCAL, read_only=True)
+    _con = _connect()
+    _con_state = _db_state(_con)
     return _con
 
 
 def _get_manifest():
     """Return the file/table manifest, downloading from S3 on cold start."""
-    global _manifest
+    global _manifest, _manifest_etag, _sync_checked_at
     if _manifest is None:
-        s3.download_file(S3_BUCKET, "index/manifest.json", MANIFEST_LOCAL)
-        with open(MANIFEST_LOCAL) as fh:
-            _manifest = json.load(fh)
+        s3 = _s3()
+        try:
+            obj = s3.get_object(Bucket=S3_BUCKET, Key=MANIFEST_KEY)
+            _manifest = orjson.loads(gzip.decompress(obj["Body"].read()))
+        except s3.exceptions.NoSuchKey:
+            obj = s3.get_object(Bucket=S3_BUCKET, Key=LEGACY_MANIFEST_KEY)
+            _manifest = orjson.loads(obj["Body"].read())
+        _manifest_etag = obj["ETag"]
+        _sync_checked_at = time.monotonic()
+        # Sync writes the list sorted already (making this a linear pass);
+        # list_repo_files relies on the order for its binary search.
+        _manifest.setdefault("files", []).sort()
     return _manifest
 
 
 def _invalidate_cache():
-    """Force re-download on next invocation (called if data looks stale)."""
-    global _con, _manifest
-    _con = None
+    """Force a reconnect on next invocation (called if data looks stale)."""
+    global _manifest, _manifest_etag
+    _close_db()
     _manifest = None
+    _manifest_etag = None
+    _cached_query.cache_clear()
+    _read_repo_object.cache_clear()
+
+
+def _check_for_sync():
+    """Drop every cache if a sync has written a new manifest since we loaded.
+
+    Checked with a HEAD request at most every ``SYNC_CHECK_SECONDS``.
+    """
+    global _sync_checked_at
+    if _manifest is None or time.monotonic() - _sync_checked_at < SYNC_CHECK_SECONDS:
+        return
+    _sync_checked_at = time.monotonic()
+    try:
+        etag = _s3().head_object(Bucket=S3_BUCKET, Key=MANIFEST_KEY)["ETag"]
+    except ClientError as exc:
+        # Still on a legacy manifest and no new sync has run yet
+        if exc.response["Error"]["Code"] == "404":
+            return
+        print(f"Sync check failed: {exc}")
+        return
+    except Exception as exc:
+        print(f"Sync check failed: {exc}")
+        return
+    if etag != _manifest_etag:
+        print("Index changed since last load; invalidating caches")
+        _invalidate_cache()
 
 
 # ── tool implementations ─────────────────────────────────────────────────
 
+def _run_query(sql: str) -> str:
+    """Execute ``sql`` and format the result."""
+    statement = sql.strip().rstrip(";")
+    with _get_db().cursor() as cur:
+        if _SELECT_RE.match(statement) and ";" not in statement:
+            # Let DuckDB count the full result in the same pass and hand back
+            # only the rows we display (plus one to detect overflow), so the
+            # remainder is never converted into Python objects.
+            try:
+                result = cur.execute(
+                    f"SELECT *, count(*) OVER () AS __total FROM (\n{statement}\n) "
+                    "LIMIT 101"
+                )
+                columns = [desc[0] for desc in result.description][:-1]
+                rows = result.fetchall()
+                total = rows[0][-1] if rows else 0
+                rows = [row[:-1] for row in rows]
+            except duckdb.Error:
+                # Not wrappable as a subquery; the plain path reports any
+                # genuine error
+                result = None
+        else:
+            result = None
+        if result is None:
+            result = cur.execute(sql)
+            columns = [desc[0] for desc in result.description]
+            rows = result.fetchall()
+            total = len(rows)
+
+    if not rows:
+        return f"Query returned 0 rows.\nColumns: {', '.join(columns)}"
+
+    # Cap displayed rows at 100
+    display, truncated = rows[:100], total > 100
+    header = " | ".join(columns)
+    sep = " | ".join("---" for _ in columns)
+    body = "\n".join(" | ".join(str(v) for v in row) for row in display)
+    tail = f"\n\n... ({total - 100} more rows)" if truncated else ""
+
+    return (
+        f"Rows returned: {total}\n\n"
+        f"{header}\n{sep}\n{body}{tail}"
+    )
+
+
+# Identical deterministic SELECTs within a warm container return the cached
+# text instead of re-running the parse/plan/scan; _check_for_sync clears it
+# when a sync replaces the data. Errors propagate and are never cached.
+_cached_query = lru_cache(maxsize=64)(_run_query)
+
+
+def _is_cacheable(sql: str) -> bool:
+    """True for a single SELECT/WITH/FROM statement with nothing volatile in it."""
+    statement = sql.strip().rstrip(";")
+    return (
+        _SELECT_RE.match(statement) is not None
+        and ";" not in statement
+        and _UNCACHEABLE_RE.search(statement) is None
+    )
+
+
 def query_data(sql: str) -> str:
     """Run a SQL query against the indexed CSV data."""
-    con = _get_db()
     try:
-        result = con.execute(sql)
-        columns = [desc[0] for desc in result.description]
-        rows = result.fetchall()
-
-        if not rows:
-            return f"Query returned 0 rows.\nColumns: {', '.join(columns)}"
-
-        # Cap displayed rows at 100
-        display, truncated = rows[:100], len(rows) > 100
-        header = " | ".join(columns)
-        sep = " | ".join("---" for _ in columns)
-        body = "\n".join(" | ".join(str(v) for v in row) for row in display)
-        tail = f"\n\n... ({len(rows) - 100} more rows)" if truncated else ""
-
-        return (
-            f"Rows returned: {len(rows)}\n\n"
-            f"{header}\n{sep}\n{body}{tail}"
-        )
+        if _is_cacheable(sql):
+            return _cached_query(sql)
+        return _run_query(sql)
     except Exception as exc:
         return f"SQL error: {exc}"
 
 
 def list_tables() -> str:
-    """List all available tables with row counts."""
-    con = _get_db()
-    manifest = _get_manifest()
-    tables = con.execute("SHOW TABLES").fetchall()
+    """List all available tables with row counts (as recorded at sync time)."""
+    tables = _get_manifest().get("tables", [])
 
     if not tables:
         return "No tables have been indexed yet."
 
-    lines = []
-    for (name,) in tables:
-        count = con.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
-        source = next(
-            (t["source"] for t in manifest.get("tables", []) if t["name"] == name),
-            "unknown",
-        )
-        lines.append(f"- {name}  ({count:,} rows, source: {source})")
-
+    lines = [
+        f"- {t['name']}  ({t['row_count']:,} rows, source: {t['source']})"
+        for t in tables
+    ]
     return "Available tables:\n" + "\n".join(lines)
 
 
 def describe_table(table_name: str) -> str:
     """Return columns + a 5-row sample for a table."""
-    con = _get_db()
     try:
-        cols = con.execute(f'DESCRIBE "{table_name}"').fetchall()
-        sample = con.execute(f'SELECT * FROM "{table_name}" LIMIT 5').fetchall()
+        with _get_db().cursor() as cur:
+            cols = cur.execute(f'DESCRIBE "{table_name}"').fetchall()
+            sample = cur.execute(f'SELECT * FROM "{table_name}" LIMIT 5').fetchall()
         col_names = [c[0] for c in cols]
 
         schema = f"Table: {table_name}\n\nColumns:\n"
@@ -130,27 +356,60 @@ def describe_table(table_name: str) -> str:
 
 def list_repo_files(path_prefix: str = "") -> str:
     """List files that were synced from the GitHub repo."""
-    manifest = _get_manifest()
-    files = manifest.get("files", [])
+    files = _get_manifest()["files"]
     if path_prefix:
-        files = [f for f in files if f.startswith(path_prefix)]
+        # Files sharing the prefix form one contiguous run of the sorted
+        # list, ending just before the first string past every match.
+        upper = path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)
+        files = files[bisect_left(files, path_prefix):bisect_left(files, upper)]
     if not files:
         return "No files found." + (f" (filter: {path_prefix})" if path_prefix else "")
-    return "Repository files:\n" + "\n".join(f"- {f}" for f in sorted(files))
+    return "Repository files:\n" + "\n".join(f"- {f}" for f in files)
+
+
+@lru_cache(maxsize=64)
+def _read_repo_object(file_path: str) -> tuple[bytes, int]:
+    """Fetch the head of a repo file from S3 (memoized per path).
+
+    Returns at most ``MAX_FILE_BYTES`` bytes via a ranged GET, plus the
+    object's full size.
+    """
+    try:
+        obj = _s3().get_object(
+            Bucket=S3_BUCKET,
+            Key=f"repo/{file_path}",
+            Range=f"bytes=0-{MAX_FILE_BYTES - 1}",
+        )
+    except ClientError as exc:
+        # S3 rejects any range on an empty object
+        if exc.response["Error"]["Code"] == "InvalidRange":
+            return b"", 0
+        raise
+    content = obj["Body"].read()
+    # ContentRange looks like "bytes 0-79999/123456"; it is absent when S3
+    # answers with the whole object
+    if "ContentRange" in obj:
+        return content, int(obj["ContentRange"].rsplit("/", 1)[1])
+    return content, len(content)
 
 
 def read_repo_file(file_path: str) -> str:
     """Read the contents of a single file from the synced repo."""
+    s3 = _s3()
     try:
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=f"repo/{file_path}")
-        content = obj["Body"].read()
+        content, size = _read_repo_object(file_path)
         try:
-            text = content.decode("utf-8")
-            if len(text) > 20_000:
-                return text[:20_000] + f"\n\n... (truncated, total {len(text):,} chars)"
+            # A partial read may end partway through a multi-byte character;
+            # the incremental decoder holds that tail back instead of failing.
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            text = decoder.decode(content, final=len(content) == size)
+            if len(content) < size:
+                return text[:MAX_FILE_CHARS] + f"\n\n... (truncated, total {size:,} bytes)"
+            if len(text) > MAX_FILE_CHARS:
+                return text[:MAX_FILE_CHARS] + f"\n\n... (truncated, total {len(text):,} chars)"
             return text
         except UnicodeDecodeError:
-            return f"Binary file ({len(content):,} bytes). Cannot display as text."
+            return f"Binary file ({size:,} bytes). Cannot display as text."
     except s3.exceptions.NoSuchKey:
         return f"File not found: {file_path}"
     except Exception as exc:
@@ -159,23 +418,29 @@ def read_repo_file(file_path: str) -> str:
 
 # ── Bedrock Agent dispatcher ────────────────────────────────────────────
 
+# function name → (implementation, ((parameter name, default), ...))
 _TOOLS = {
-    "query_data": lambda p: query_data(p.get("sql", "")),
-    "list_tables": lambda p: list_tables(),
-    "describe_table": lambda p: describe_table(p.get("table_name", "")),
-    "list_repo_files": lambda p: list_repo_files(p.get("path_prefix", "")),
-    "read_repo_file": lambda p: read_repo_file(p.get("file_path", "")),
+    "query_data": (query_data, (("sql", ""),)),
+    "list_tables": (list_tables, ()),
+    "describe_table": (describe_table, (("table_name", ""),)),
+    "list_repo_files": (list_repo_files, (("path_prefix", ""),)),
+    "read_repo_file": (read_repo_file, (("file_path", ""),)),
 }
 
 
 def handler(event, context):
+    # Let the INIT-time prefetch finish before touching the shared globals
+    _prefetch_thread.join()
+    _check_for_sync()
+
     function_name = event.get("function", "")
     action_group = event.get("actionGroup", "")
     parameters = {p["name"]: p["value"] for p in event.get("parameters", [])}
 
     tool = _TOOLS.get(function_name)
     if tool:
-        result = tool(parameters)
+        fn, schema = tool
+        result = fn(*(parameters.get(name, default) for name, default in schema))
     else:
         result = f"Unknown function: {function_name}"
 
@@ -189,3 +454,20 @@ def handler(event, context):
             },
         },
     }
+
+
+# ── cold-start prefetch ──────────────────────────────────────────────────
+# Fetch the manifest, load httpfs and build the table views in the
+# background during INIT, overlapping that S3 / extension I/O with the rest
+# of runtime start-up instead of adding it to the first request.
+
+def _prefetch():
+    try:
+        _get_db()
+    except Exception as exc:
+        # Leave the globals unset; the first request retries synchronously
+        print(f"Prefetch failed: {exc}")
+
+
+_prefetch_thread = threading.Thread(target=_prefetch, daemon=True)
+_prefetch_thread.start()
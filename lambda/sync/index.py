@@ -1,27 +1,54 @@
 """
-Sync Lambda: Downloads a GitHub repo, indexes CSV files into DuckDB,
-and stores everything in S3 for the Bedrock Agent to query.
+Sync Lambda: Downloads a GitHub repo, loads CSV files through DuckDB into
+one Parquet file per table, and stores everything in S3 for the Bedrock
+Agent to query.
+
+Files are streamed straight from the tarball to S3; only CSVs are staged
+on local disk for DuckDB to read.
 
 Triggered weekly by EventBridge (or manually).
 """
 
-import json
+import gzip
+import hashlib
 import os
+import shutil
 import tarfile
 import tempfile
+import threading
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import duckdb
+import orjson
+from botocore.config import Config
 
 GITHUB_REPO = os.environ["GITHUB_REPO"]
 GITHUB_BRANCH = os.environ.get("GITHUB_BRANCH", "main")
 S3_BUCKET = os.environ["S3_BUCKET"]
 
-s3 = boto3.client("s3")
+# Repo files are mostly small, so uploads are latency-bound — run them in
+# parallel, with enough pooled connections that workers never wait on one.
+UPLOAD_WORKERS = 32
+
+# ── globals reused across warm invocations ───────────────────────────────
+_s3_client = None
+
+
+def _s3():
+    """Return the S3 client, created on first use."""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
+            "s3", config=Config(max_pool_connections=2 * UPLOAD_WORKERS)
+        )
+    return _s3_client
 
 
 def handler(event, context):
+    s3 = _s3()
+
     with tempfile.TemporaryDirectory() as tmpdir:
         # ── 1. Download repo tarball ─────────────────────────────────────
         tarball_url = (
@@ -35,45 +62,120 @@ def handler(event, context):
         )
         with urllib.request.urlopen(req) as resp:
             with open(tarball_path, "wb") as f:
-                f.write(resp.read())
-
-        # ── 2. Extract tarball ───────────────────────────────────────────
-        extract_dir = os.path.join(tmpdir, "repo")
-        os.makedirs(extract_dir)
-        with tarfile.open(tarball_path) as tar:
-            tar.extractall(extract_dir, filter="data")
+                # Stream to disk in 1 MiB chunks rather than buffering it all
+                shutil.copyfileobj(resp, f, 1024 * 1024)
 
-        # GitHub tarballs contain a single top-level directory (owner-repo-sha/)
-        top_dirs = os.listdir(extract_dir)
-        repo_root = os.path.join(extract_dir, top_dirs[0])
-
-        # ── 3. Walk files, upload to S3, collect CSV paths ───────────────
+        # ── 2. Stream tarball members to S3, stage CSV files ─────────────
         manifest = {"repo": GITHUB_REPO, "branch": GITHUB_BRANCH, "files": [], "tables": []}
         csv_files = []
-
-        for root, dirs, files in os.walk(repo_root):
-            dirs[:] = [d for d in dirs if not d.startswith(".")]
-            for fname in files:
-                if fname.startswith("."):
-                    continue
-                full_path = os.path.join(root, fname)
-                rel_path = os.path.relpath(full_path, repo_root)
-
-                with open(full_path, "rb") as fh:
-                    s3.put_object(
-                        Bucket=S3_BUCKET, Key=f"repo/{rel_path}", Body=fh.read()
-                    )
+        csv_dir = os.path.join(tmpdir, "csv")
+        os.makedirs(csv_dir)
+
+        # ETags of what the previous sync uploaded. For single-part PUTs the
+        # ETag is the body's MD5, so unchanged files can skip the upload.
+        existing = {}
+        for page in s3.get_paginator("list_objects_v2").paginate(
+            Bucket=S3_BUCKET, Prefix="repo/"
+        ):
+            for obj in page.get("Contents", []):
+                existing[obj["Key"]] = obj["ETag"]
+
+        # Cap the number of file bodies held in memory while awaiting upload
+        in_flight = threading.BoundedSemaphore(2 * UPLOAD_WORKERS)
+
+        def upload(rel_path, data):
+            key = f"repo/{rel_path}"
+            try:
+                etag = f'"{hashlib.md5(data, usedforsecurity=False).hexdigest()}"'
+                if existing.get(key) == etag:
+                    return rel_path, False
+                s3.put_object(Bucket=S3_BUCKET, Key=key, Body=data)
+                return rel_path, True
+            finally:
+                in_flight.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            with tarfile.open(tarball_path) as tar:
+                for member in tar:
+                    # Same safety checks as extractall(filter="data")
+                    member = tarfile.data_filter(member, csv_dir)
+                    if member.isdir():
+                        continue
+
+                    # GitHub tarballs contain a single top-level directory
+                    # (owner-repo-sha/); paths are relative to it
+                    parts = member.name.split("/")[1:]
+                    if not parts or any(p.startswith(".") for p in parts):
+                        continue
+                    rel_path = "/".join(parts)
+
+                    # extractfile follows in-archive links, so a symlinked
+                    # file uploads its target's content (as extracting did)
+                    try:
+                        fobj = tar.extractfile(member)
+                    except KeyError:
+                        fobj = None
+                    if fobj is None:
+                        print(f"  SKIP  {rel_path}: not a regular file or link to one")
+                        continue
+                    data = fobj.read()
+                    in_flight.acquire()
+                    futures.append(pool.submit(upload, rel_path, data))
+
+                    if rel_path.lower().endswith(".csv"):
+                        full_path = os.path.join(csv_dir, f"{len(csv_files)}.csv")
+                        with open(full_path, "wb") as fh:
+                            fh.write(data)
+                        csv_files.append((rel_path, full_path))
+
+            uploaded = 0
+            for future in futures:
+                rel_path, changed = future.result()
                 manifest["files"].append(rel_path)
+                uploaded += changed
 
-                if rel_path.lower().endswith(".csv"):
-                    csv_files.append((rel_path, full_path))
+        # Sorted so the query Lambda can prefix-filter with a binary search
+        manifest["files"].sort()
 
-        print(f"Uploaded {len(manifest['files'])} files to S3")
+        print(
+            f"Uploaded {uploaded} of {len(manifest['files'])} files to S3 "
+            f"({len(manifest['files']) - uploaded} unchanged)"
+        )
 
-        # ── 4. Build DuckDB index from CSV files ────────────────────────
+        # ── 3. Convert CSV files to Parquet via DuckDB ──────────────────
         db_path = os.path.join(tmpdir, "data.duckdb")
+        parquet_dir = os.path.join(tmpdir, "parquet")
+        os.makedirs(parquet_dir)
         con = duckdb.connect(db_path)
 
+        def load(table_name, full_path):
+            # Each worker gets its own cursor (an independent connection to
+            # the same database), so tables load concurrently.
+            cur = con.cursor()
+            try:
+                cur.execute(
+                    f"CREATE TABLE \"{table_name}\" AS "
+                    f"SELECT * FROM read_csv_auto('{full_path}')"
+                )
+                row_count = cur.execute(
+                    f'SELECT COUNT(*) FROM "{table_name}"'
+                ).fetchone()[0]
+                parquet_path = os.path.join(parquet_dir, f"{table_name}.parquet")
+                cur.execute(
+                    f"COPY \"{table_name}\" TO '{parquet_path}' "
+                    "(FORMAT PARQUET, COMPRESSION ZSTD)"
+                )
+                return row_count
+            except Exception:
+                # Free the name for the next CSV that maps to it
+                cur.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                raise
+            finally:
+                cur.close()
+
+        # table name → CSVs that map to it, in tarball order
+        candidates = {}
         for rel_path, full_path in csv_files:
             # Derive a clean table name from the filename
             table_name = os.path.splitext(os.path.basename(rel_path))[0]
@@ -83,31 +185,60 @@ def handler(event, context):
             table_name = "".join(
                 c if c.isalnum() or c == "_" else "_" for c in table_name
             )
-
-            try:
-                con.execute(
-                    f"CREATE TABLE \"{table_name}\" AS "
-                    f"SELECT * FROM read_csv_auto('{full_path}')"
-                )
-                row_count = con.execute(
-                    f'SELECT COUNT(*) FROM "{table_name}"'
-                ).fetchone()[0]
-                manifest["tables"].append(
-                    {"name": table_name, "source": rel_path, "row_count": row_count}
-                )
-                print(f"  Table '{table_name}' ← {rel_path} ({row_count} rows)")
-            except Exception as e:
-                print(f"  SKIP  {rel_path}: {e}")
+            candidates.setdefault(table_name, []).append((rel_path, full_path))
+
+        # Load the first candidate for every name concurrently. As with
+        # serial loading, the first CSV that loads claims the name; when
+        # one fails, the next same-named CSV is tried in the following round.
+        loaded = {}
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            while candidates:
+                batch = [
+                    (table_name, *paths.pop(0))
+                    for table_name, paths in candidates.items()
+                ]
+                futures = [
+                    pool.submit(load, table_name, full_path)
+                    for table_name, _, full_path in batch
+                ]
+                for (table_name, rel_path, _), future in zip(batch, futures):
+                    try:
+                        row_count = future.result()
+                    except Exception as e:
+                        print(f"  SKIP  {rel_path}: {e}")
+                        if not candidates[table_name]:
+                            del candidates[table_name]
+                        continue
+                    loaded[rel_path] = {
+                        "name": table_name,
+                        "source": rel_path,
+                        "row_count": row_count,
+                        "parquet": f"index/{table_name}.parquet",
+                    }
+                    print(f"  Table '{table_name}' ← {rel_path} ({row_count} rows)")
+                    for other, _ in candidates.pop(table_name):
+                        print(f"  SKIP  {other}: table '{table_name}' already exists")
+
+        # Manifest lists tables in tarball order, independent of load rounds
+        manifest["tables"] = [
+            loaded[rel_path] for rel_path, _ in csv_files if rel_path in loaded
+        ]
 
         con.close()
 
-        # ── 5. Upload DuckDB database + manifest to S3 ──────────────────
-        s3.upload_file(db_path, S3_BUCKET, "index/data.duckdb")
+        # ── 4. Upload Parquet tables + manifest to S3 ───────────────────
+        for table in manifest["tables"]:
+            s3.upload_file(
+                os.path.join(parquet_dir, f"{table['name']}.parquet"),
+                S3_BUCKET,
+                table["parquet"],
+            )
         s3.put_object(
             Bucket=S3_BUCKET,
-            Key="index/manifest.json",
-            Body=json.dumps(manifest, indent=2),
+            Key="index/manifest.json.gz",
+            Body=gzip.compress(orjson.dumps(manifest), 9),
             ContentType="application/json",
+            ContentEncoding="gzip",
         )
         print(f"Index complete: {len(manifest['tables'])} tables")
 
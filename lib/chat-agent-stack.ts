@@ -6,6 +6,7 @@ import * as apigatewayv2 from "aws-cdk-lib/aws-apigatewayv2";
 import * as apigatewayv2_integrations from "aws-cdk-lib/aws-apigatewayv2-integrations";
 import * as cloudfront from "aws-cdk-lib/aws-cloudfront";
 import * as cloudfront_origins from "aws-cdk-lib/aws-cloudfront-origins";
+import * as ecr_assets from "aws-cdk-lib/aws-ecr-assets";
 import * as events from "aws-cdk-lib/aws-events";
 import * as targets from "aws-cdk-lib/aws-events-targets";
 import * as iam from "aws-cdk-lib/aws-iam";
@@ -82,10 +83,11 @@ export class ChatAgentStack extends cdk.Stack {
     });
 
     // ── Query Lambda — Bedrock Agent action-group handler ─────────────
-    const queryFn = new lambda.Function(this, "QueryFunction", {
-      runtime: lambda.Runtime.PYTHON_3_12,
-      handler: "index.handler",
-      code: lambda.Code.fromAsset("lambda/query", { bundling: pythonBundling }),
+    // Container image with DuckDB + httpfs baked in (see lambda/query/Dockerfile)
+    const queryFn = new lambda.DockerImageFunction(this, "QueryFunction", {
+      code: lambda.DockerImageCode.fromImageAsset("lambda/query", {
+        platform: ecr_assets.Platform.LINUX_AMD64,
+      }),
       timeout: cdk.Duration.minutes(2),
       memorySize: 1024,
       ephemeralStorageSize: cdk.Size.gibibytes(2),